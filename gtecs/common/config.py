@@ -1,18 +1,25 @@
 """Package configuration functions."""
 
+import functools
 import os
 from pathlib import Path
 
 
+@functools.lru_cache(maxsize=1)
 def get_config_path():
-    """Get the location of the system config directory."""
+    """Get the location of the system config directory.
+
+    The result is cached, so the environment is only checked once per process.
+    """
     # This is based on https://github.com/srstevenson/xdg
-    path = os.environ.get('XDG_CONFIG_HOME')
-    if path and os.path.isabs(path):
+    # Per the XDG spec, an unset, empty or relative path should be ignored
+    path = os.environ.get('XDG_CONFIG_HOME') or ''
+    if path.startswith('/'):
         return Path(path)
     return Path.home() / '.config'
 
 
+@functools.lru_cache(maxsize=None)
 def get_package_config_path(package_name='gtecs'):
     """Get the location of the config directory for the given package."""
     base_path = get_config_path()
@@ -1,25 +1,83 @@
 """Database management functions."""
 
+import functools
 import os
 
-import numpy as np
-
-import pymysql
-
-from sqlalchemy import create_engine, text
+from sqlalchemy import String, create_engine, text
 from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateSchema, DropSchema
+
+
+# Driver error codes for trying to create something that already exists
+# (PostgreSQL duplicate_database and duplicate_schema, MySQL ER_DB_CREATE_EXISTS)
+_DUPLICATE_ERROR_CODES = {'42P04', '42P06', '1007'}
+
+
+def _is_duplicate_error(err):
+    """Check if a ProgrammingError was raised because the database or schema already exists."""
+    code = getattr(err.orig, 'pgcode', None)
+    if code is None and getattr(err.orig, 'args', None):
+        code = err.orig.args[0]
+    return str(code) in _DUPLICATE_ERROR_CODES
+
+
+@functools.lru_cache(maxsize=1)
+def _register_pymysql_numpy():
+    """Register the encoder for Numpy floats with PyMySQL.
 
+    This is only needed for MySQL, so it's done on first use to avoid importing
+    numpy and pymysql otherwise.
+    """
+    import numpy as np
+    import pymysql
+
+    # Encode Numpy floats
+    # https://stackoverflow.com/questions/46205532/
+    pymysql.converters.encoders[np.float64] = pymysql.converters.escape_float
+    pymysql.converters.conversions = pymysql.converters.encoders.copy()
+    pymysql.converters.conversions.update(pymysql.converters.decoders)
+
+
+# Engines that have been cached by `_cached_engine`, which live for the lifetime of the process
+_cached_engines = set()
 
-# Encode Numpy floats
-# https://stackoverflow.com/questions/46205532/
-pymysql.converters.encoders[np.float64] = pymysql.converters.escape_float
-pymysql.converters.conversions = pymysql.converters.encoders.copy()
-pymysql.converters.conversions.update(pymysql.converters.decoders)
+
+@functools.lru_cache(maxsize=None)
+def _cached_engine(url, echo, pool_pre_ping, connect_args_items, kwargs_items):
+    """Create a new engine, or return the existing one for the same parameters.
+
+    Engines (and their connection pools) are designed to be shared, so there is no need to create
+    a new one every time we want a session. Note the cache key includes the connection URL,
+    so the password is held in memory for the lifetime of the process.
+    """
+    engine = create_engine(url,
+                           echo=echo,
+                           pool_pre_ping=pool_pre_ping,
+                           connect_args=dict(connect_args_items),
+                           **dict(kwargs_items),
+                           )
+    _cached_engines.add(engine)
+    return engine
+
+
+def _dispose_cached_engines():
+    """Reset the connection pools of all cached engines.
+
+    This is called in the child after a fork, since connections can't be shared between processes.
+    Using `close=False` means the child just forgets the parent's connections rather than closing
+    them (which would break them for the parent), the engines will make new ones when needed.
+    """
+    for engine in _cached_engines:
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_dispose_cached_engines)
 
 
 def get_engine(user, password, db_name='gtecs', host='localhost', dialect='postgres',
-               encoding='utf8', echo=False, pool_pre_ping=True,
+               encoding='utf8', echo=False, pool_pre_ping=False,
+               pool_size=None, max_overflow=None, pool_recycle=1800,
                **kwargs):
     """Create a new database engine.
 
@@ -40,8 +98,21 @@ def get_engine(user, password, db_name='gtecs', host='localhost', dialect='postg
         The encoding to use when connecting to the database.
     echo : bool, default=False
         Whether to echo SQL commands to the console.
-    pool_pre_ping : bool, default=True
+    pool_pre_ping : bool, default=False
         Whether to ping the database before each connection.
+        This adds an extra round-trip every time a connection is checked out of the pool,
+        so it is only worth enabling if you're seeing problems with stale connections
+        (`pool_recycle` should handle connections timing out while idle).
+    pool_size : int, default=None
+        The number of connections to keep open in the pool.
+        If None, use the SQLAlchemy default (5).
+        Leave as None if giving a `poolclass` that doesn't take a size (e.g. NullPool).
+    max_overflow : int, default=None
+        The number of connections to allow beyond `pool_size` when the pool is exhausted.
+        If None, use the SQLAlchemy default (10).
+        Leave as None if giving a `poolclass` that doesn't take a size (e.g. NullPool).
+    pool_recycle : int or None, default=1800
+        Recycle connections after this many seconds (use -1 or None to disable).
 
     **kwargs
         Additional keyword arguments to pass to `sqlalchemy.create_engine`.
@@ -50,19 +121,24 @@ def get_engine(user, password, db_name='gtecs', host='localhost', dialect='postg
     -------
     engine : sqlalchemy.engine.base.Engine
         The database engine.
+        Engines are cached, so calling this again with the same arguments returns the same
+        engine (and connection pool) rather than creating a new one.
+        If the process is forked (e.g. by `multiprocessing`) the child inherits the cached engines,
+        but their pools are reset so it never uses the parent's connections.
 
     """
-    url = '{}:{}@{}'.format(user, password, host)
+    url = f'{user}:{password}@{host}'
 
     if db_name:
-        url = os.path.join(url, db_name)
+        url = f'{url}/{db_name}'
     else:
         # db_name = None is used when creating databases
         if 'postgres' in dialect:
-            url = os.path.join(url, 'postgres')
+            url = f'{url}/postgres'
 
     connect_args = {}
     if dialect == 'mysql':
+        _register_pymysql_numpy()
         dialect = 'mysql+pymysql'
         connect_args['charset'] = encoding
     elif dialect == 'postgres':
@@ -72,26 +148,118 @@ def get_engine(user, password, db_name='gtecs', host='localhost', dialect='postg
     else:
         raise ValueError(f'Unknown SQL dialect: {dialect}')
 
-    engine = create_engine(f'{dialect.lower()}://{url}',
-                           echo=echo,
-                           pool_pre_ping=pool_pre_ping,
-                           connect_args=connect_args,
-                           **kwargs,
-                           )
+    url = f'{dialect.lower()}://{url}'
+    pool_kwargs = {'pool_size': pool_size,
+                   'max_overflow': max_overflow,
+                   'pool_recycle': pool_recycle,
+                   }
+    kwargs.update({key: value for key, value in pool_kwargs.items() if value is not None})
+    connect_args_items = tuple(sorted(connect_args.items()))
+    kwargs_items = tuple(sorted(kwargs.items()))
+    try:
+        hash(kwargs_items)
+    except TypeError:
+        # Some of the kwargs aren't hashable, so we can't cache this engine
+        engine = create_engine(url,
+                               echo=echo,
+                               pool_pre_ping=pool_pre_ping,
+                               connect_args=connect_args,
+                               **kwargs,
+                               )
+    else:
+        engine = _cached_engine(url, echo, pool_pre_ping, connect_args_items, kwargs_items)
     return engine
 
 
+@functools.lru_cache(maxsize=None)
+def _cached_sessionmaker(engine):
+    """Get a session factory bound to the given (cached) engine."""
+    return sessionmaker(bind=engine)
+
+
+def _get_sessionmaker(engine):
+    """Get a session factory bound to the given engine.
+
+    Factories are only cached for engines that are cached themselves,
+    otherwise the cache would keep every uncached engine (and its pool) alive forever.
+    """
+    if engine in _cached_engines:
+        return _cached_sessionmaker(engine)
+    return sessionmaker(bind=engine)
+
+
 def get_session(*args, **kwargs):
     """Create a database session.
 
     All arguments are passed to `get_engine`.
     """
     engine = get_engine(*args, **kwargs)
-    new_session = sessionmaker(bind=engine)
+    new_session = _get_sessionmaker(engine)
     session = new_session()
     return session
 
 
+class LazySession:
+    """A database session that is only created when it is first used.
+
+    Creating the engine means importing the dialect and setting up the connection pool,
+    which is wasted effort for processes that create a session but never end up using it.
+    Any attribute access (or entering it as a context manager) creates the real session,
+    except for `close()` which does nothing if it was never used.
+
+    All arguments are passed to `get_session`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._args = args
+        self._kwargs = kwargs
+        self._session = None
+
+    @property
+    def session(self):
+        """Get the underlying session, creating it if needed."""
+        if self._session is None:
+            self._session = get_session(*self._args, **self._kwargs)
+        return self._session
+
+    def __getattr__(self, name):
+        # Private names (including our own, if they haven't been set yet e.g. when copying)
+        # aren't passed on, otherwise looking up `_session` here would recurse forever
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.session, name)
+
+    def close(self):
+        """Close the session, if it has been created (otherwise there's nothing to do)."""
+        if self._session is not None:
+            self._session.close()
+
+    def __enter__(self):
+        return self.session.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.session.__exit__(*exc_info)
+
+
+def get_session_lazy(*args, **kwargs):
+    """Create a database session which defers connecting until it is first used.
+
+    All arguments are passed to `get_engine`.
+    """
+    return LazySession(*args, **kwargs)
+
+
+def _create_tables(conn, base, sql_code=None):
+    """Create the tables defined in the base class, then execute any additional SQL code."""
+    # Fill the new database/schema with tables defined in the base class
+    base.metadata.create_all(bind=conn)
+
+    # Finally execute any functions or triggers in pure SQL
+    if sql_code:
+        for code in sql_code:
+            conn.execute(text(code))
+
+
 def create_database(base, name, user, password, host='localhost', dialect='postgres',
                     overwrite=False, description=None, sql_code=None, verbose=False,
                     **kwargs):
@@ -151,12 +319,16 @@ def create_database(base, name, user, password, host='localhost', dialect='postg
                 create_command += ' CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci'
                 conn.execute(text(create_command))
             except ProgrammingError as err:
-                if 'exists' in str(err):
+                if _is_duplicate_error(err):
                     err_str = f'Database "{db_name}" already exists (and overwrite=False)'
                     raise ValueError(err_str) from err
                 else:
                     raise
 
+        # Now fill the new database with tables, in a single transaction
+        with engine.begin() as conn:
+            _create_tables(conn, base, sql_code)
+
     elif dialect == 'postgres':
         db_name = 'gtecs'
         # First connect to "None" database
@@ -169,7 +341,7 @@ def create_database(base, name, user, password, host='localhost', dialect='postg
                 conn.execute(text('commit'))
                 conn.execute(text(f'CREATE DATABASE {db_name}'))
             except ProgrammingError as err:
-                if 'exists' in str(err):
+                if _is_duplicate_error(err):
                     # We don't actually mind if the *database* exists, we want to reset the *schema*
                     # Plus there might be other schemas in the database that we don't want to drop!
                     pass
@@ -181,30 +353,26 @@ def create_database(base, name, user, password, host='localhost', dialect='postg
         # Get the schema name from the base if not given
         if name is None:
             name = base.metadata.schema
-        with engine.connect() as conn:
+        # Unlike the database, everything else can be done within a single transaction
+        # (so if anything fails it will all be rolled back)
+        with engine.begin() as conn:
             # First drop the schema, if overwrite is true
             if overwrite:
-                conn.execute(text(f'DROP SCHEMA IF EXISTS {name} CASCADE'))
+                conn.execute(DropSchema(name, cascade=True, if_exists=True))
             # Now try creating the new schema
             try:
-                conn.execute(text(f'CREATE SCHEMA {name}'))
-                conn.execute(text('commit'))
-                if description is not None:
-                    conn.execute(text(f"COMMENT ON SCHEMA {name} IS '{description}'"))
+                conn.execute(CreateSchema(name))
             except ProgrammingError as err:
-                if 'exists' in str(err):
+                if _is_duplicate_error(err):
                     err_str = f'Schema "gtecs.{name}" already exists (and overwrite=False)'
                     raise ValueError(err_str) from err
                 else:
                     raise
-
-    # Now fill the new database/schema with tables defined in the base class
-    engine = get_engine(user, password, db_name=db_name, dialect=dialect, echo=verbose, **kwargs)
-    base.metadata.create_all(engine)
-
-    # Finally execute any functions or triggers in pure SQL
-    if sql_code is not None:
-        with engine.connect() as conn:
-            for code in sql_code:
-                conn.execute(text(code))
-                conn.commit()
+            if description is not None:
+                # Postgres doesn't accept bound parameters here, so quote them ourselves.
+                # The literal is already escaped for the driver (including doubling any '%'),
+                # so send it directly rather than through text() which would escape it again.
+                schema = conn.dialect.identifier_preparer.quote_schema(name)
+                comment = String().literal_processor(conn.dialect)(description)
+                conn.exec_driver_sql(f'COMMENT ON SCHEMA {schema} IS {comment}')
+            _create_tables(conn, base, sql_code)
@@ -2,6 +2,7 @@
 
 import logging
 import sys
+import threading
 import time
 from io import TextIOBase
 from logging import handlers
@@ -10,6 +11,42 @@ from pathlib import Path
 from . import config
 
 
+# Formatter for file logging; does not include name of log (since it's the file name)
+_FILE_FORMATTER = logging.Formatter(
+    '%(asctime)s.%(msecs)03d:%(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+_FILE_FORMATTER.converter = time.gmtime
+
+# Formatter for stdout logging; includes name of log
+_STREAM_FORMATTER = logging.Formatter(
+    '%(asctime)s.%(msecs)03d:%(name)s:%(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+_STREAM_FORMATTER.converter = time.gmtime
+
+
+class ThrottledWatchedFileHandler(handlers.WatchedFileHandler):
+    """A WatchedFileHandler that only checks if the log file has been rotated periodically.
+
+    The standard WatchedFileHandler calls `os.stat` on the log file before every record,
+    here we only check at most once every `check_interval` seconds.
+    """
+
+    def __init__(self, filename, check_interval=1, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.check_interval = check_interval
+        self._last_check = time.monotonic()
+
+    def emit(self, record):
+        """Emit a record, reopening the file first if it has been rotated."""
+        now = time.monotonic()
+        if now - self._last_check > self.check_interval:
+            self._last_check = now
+            self.reopenIfNeeded()
+        logging.FileHandler.emit(self, record)
+
+
 def get_file_handler(name, out_path=None):
     """Get the file handler."""
     if out_path is None:
@@ -17,30 +54,16 @@ def get_file_handler(name, out_path=None):
     log_file = f'{name}.log'
     log_path = out_path / log_file
 
-    # formatter for file logging; does not include name of log (since it's the file name)
-    formatter = logging.Formatter(
-        '%(asctime)s.%(msecs)03d:%(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    formatter.converter = time.gmtime
-
-    handler = handlers.WatchedFileHandler(log_path, delay=True)
-    handler.setFormatter(formatter)
+    handler = ThrottledWatchedFileHandler(log_path, delay=True)
+    handler.setFormatter(_FILE_FORMATTER)
     handler.setLevel(logging.DEBUG)
     return handler
 
 
 def get_stream_handler():
     """Get the stream handler."""
-    # formatter for stdout logging; includes name of log
-    formatter = logging.Formatter(
-        '%(asctime)s.%(msecs)03d:%(name)s:%(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    formatter.converter = time.gmtime
-
     handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(formatter)
+    handler.setFormatter(_STREAM_FORMATTER)
     handler.setLevel(logging.INFO)
     return handler
 
@@ -51,16 +74,49 @@ class StreamToLogger(TextIOBase):
     def __init__(self, logger, log_level=logging.INFO):
         self.logger = logger
         self.log_level = log_level
-        self.linebuf = ''
+        # This replaces sys.stdout/stderr so it's shared by every thread, but we don't want
+        # partial lines from different threads to be mixed together, so each gets its own buffer
+        self._local = threading.local()
+
+    @property
+    def linebuf(self):
+        """The partial line written so far by the current thread."""
+        return getattr(self._local, 'linebuf', '')
+
+    @linebuf.setter
+    def linebuf(self, value):
+        self._local.linebuf = value
+
+    def _log_line(self, line):
+        """Log a single line."""
+        line = line.rstrip()
+        if not line:
+            return
+        # Build the record directly rather than using logger.log(),
+        # which would walk the stack to find the caller for every line
+        record = self.logger.makeRecord(
+            self.logger.name, self.log_level, '(stream)', 0, line, None, None
+        )
+        self.logger.handle(record)
 
     def write(self, buf):
         """Write to the stream."""
-        for line in buf.rstrip().splitlines():
-            self.logger.log(self.log_level, line.rstrip())
+        if not self.logger.isEnabledFor(self.log_level):
+            return
+        # Only log complete lines, since print() usually writes the newline separately.
+        # Anything after the last newline is kept until the next write (or flush).
+        self.linebuf += buf
+        if '\n' not in self.linebuf:
+            return
+        lines, _, self.linebuf = self.linebuf.rpartition('\n')
+        for line in lines.splitlines():
+            self._log_line(line)
 
     def flush(self):
         """Flush the stream."""
-        pass
+        if self.linebuf:
+            self._log_line(self.linebuf)
+            self.linebuf = ''
 
 
 def get_log_path():
@@ -109,8 +165,7 @@ def get_logger(name, out_path=None, capture_stdout=True, suppress_stdout=False):
         out_path = get_log_path()
     if not isinstance(out_path, Path):
         out_path = Path(out_path)
-    if not out_path.exists():
-        out_path.mkdir(parents=True, exist_ok=True)
+    out_path.mkdir(parents=True, exist_ok=True)
     log.addHandler(get_file_handler(name, out_path))
 
     # Add a handler to log to stdout
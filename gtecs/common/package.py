@@ -1,15 +1,135 @@
 """Package management functions."""
 
+import copy
+import functools
 import importlib.resources as pkg_resources
 import os
+import time
 from importlib.metadata import version
 
 from configobj import ConfigObj
 
-from fabric.connection import Connection
-
 import validate
 
+from .ssh import get_connection
+
+
+def _sftp_listdir(sftp, path):
+    """Get the names of the files in a directory on the remote end of an SFTP connection."""
+    try:
+        return set(sftp.listdir(path or '.'))
+    except FileNotFoundError:
+        return set()
+
+
+@functools.lru_cache(maxsize=None)
+def _read_configspec(package):
+    """Read the lines of the configspec file for the given package."""
+    spec_file = pkg_resources.files(f'gtecs.{package}.data').joinpath('configspec.ini')
+    return tuple(spec_file.read_text().splitlines())
+
+
+def _load_spec(package):
+    """Load the configspec for the given package.
+
+    The file is only read once, but a new ConfigObj is created each time since validating
+    a config can modify its spec.
+    """
+    return ConfigObj(list(_read_configspec(package)), _inspec=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_local_paths(env_path=None):
+    """Get the local directories to search for config files.
+
+    These are only worked out once. The `env_path` argument (the value of the 'GTECS_CONF'
+    environment variable) is part of the cache key, so any changes to it are still picked up.
+    """
+    # Options for the location of the config file:
+    # - Home directory (~)
+    # - ~/gtecs or ~/.gtecs
+    # - Any other path given by the 'GTECS_CONF' environment variable
+    home = os.path.expanduser('~')
+    paths = (home, os.path.join(home, 'gtecs'), os.path.join(home, '.gtecs'))
+    if env_path is not None:
+        paths += (env_path,)
+    return paths
+
+
+def _scan_dir(path):
+    """Get the entries in a local directory, keyed by name."""
+    try:
+        with os.scandir(path or '.') as entries:
+            return {entry.name: entry for entry in entries if entry.is_file()}
+    except OSError:
+        # Doesn't exist, isn't a directory, or we can't read it
+        return {}
+
+
+def _find_local_config(filenames):
+    """Find the first local config file that exists.
+
+    Returns the path to the file and its modification time, or (None, None) if none are found.
+    """
+    paths = _get_local_paths(os.environ.get('GTECS_CONF'))
+
+    # Rather than trying every candidate file, scan each directory once (and only when needed)
+    dir_contents = {}
+    for path in paths:
+        for file in filenames:
+            filepath = os.path.join(path, file)
+            dirname, basename = os.path.split(filepath)
+            if dirname not in dir_contents:
+                dir_contents[dirname] = _scan_dir(dirname)
+            if basename in dir_contents[dirname]:
+                try:
+                    mtime = dir_contents[dirname][basename].stat().st_mtime_ns
+                except OSError:
+                    # e.g. it's been deleted since we scanned the directory
+                    continue
+                return filepath, mtime
+    return None, None
+
+
+# Cache of the GTECS_CONF environment variable on remote hosts, keyed by (host, user)
+_remote_env_cache = {}
+
+
+def _find_remote_config(filenames, connection, sftp):
+    """Find the first config file that exists on a remote host."""
+    # The SFTP connection will automatically start in the home directory
+    paths = ['', 'gtecs', '.gtecs']
+    # We will need to check the remote environment (but only the first time for each host)
+    # TODO: I'm not sure this works? Depends how the variable is set.
+    key = (connection.host, connection.user)
+    if key not in _remote_env_cache:
+        result = connection.run('echo $GTECS_CONF', hide='both').stdout.strip()
+        _remote_env_cache[key] = result
+    result = _remote_env_cache[key]
+    if result != '':
+        paths.append(result)
+
+    # Rather than trying every candidate file, list the contents of each directory once.
+    # Note these are done one after another, since the SFTP client isn't thread-safe.
+    filepaths = [os.path.join(path, file) for path in paths for file in filenames]
+    dirnames = dict.fromkeys(os.path.dirname(filepath) for filepath in filepaths)
+    dir_contents = {dirname: _sftp_listdir(sftp, dirname) for dirname in dirnames}
+
+    # Return the first file that exists in order of preference
+    for filepath in filepaths:
+        dirname, basename = os.path.split(filepath)
+        if basename in dir_contents[dirname]:
+            return filepath
+    return None
+
+
+# Cache of loaded configs, keyed by the arguments to `load_config`
+_config_cache = {}
+
+# How long (in seconds) to reuse a config loaded from a remote host before loading it again,
+# since even checking if the remote file has changed needs a new SSH connection
+REMOTE_CONFIG_CACHE_TIME = 30
+
 
 def load_config(package, config_file, remote_host=None, remote_user=None):
     """Load and validate package configuration file.
@@ -30,82 +150,114 @@ def load_config(package, config_file, remote_host=None, remote_user=None):
         The username to use when connecting to `remote_host`.
         If None then the same username as the client is assumed.
 
+    Notes
+    -----
+    The results are cached, so calling this again with the same arguments won't re-read the file.
+    Each call returns a new copy of the config and spec though, so callers are free to modify them.
+    Local files are reloaded if the file has been modified (or a different file would be found),
+    remote files are reloaded after `REMOTE_CONFIG_CACHE_TIME` seconds.
+    Use `clear_config_cache()` to force a reload.
+
     """
     if isinstance(config_file, str):
-        filenames = [config_file]
+        filenames = (config_file,)
     else:
-        filenames = config_file
+        filenames = tuple(config_file)
+    key = (package, filenames, remote_host, remote_user)
 
-    # Options for the location of the config file:
-    # - Home directory (~)
-    # - ~/gtecs or ~/.gtecs
-    # - Any other path given by the 'GTECS_CONF' environment variable
     if remote_host is None:
-        home = os.path.expanduser('~')
-        paths = [home, os.path.join(home, 'gtecs'), os.path.join(home, '.gtecs')]
-        if 'GTECS_CONF' in os.environ:
-            paths.append(os.environ['GTECS_CONF'])
+        # Checking the file on disk is cheap, so we can tell if it's changed since we loaded it
+        config_filepath, mtime = _find_local_config(filenames)
+        if key in _config_cache and _config_cache[key][0] == (config_filepath, mtime):
+            return copy.deepcopy(_config_cache[key][1])
+        result = _load_config(package, filenames, config_filepath)
+        _config_cache[key] = ((config_filepath, mtime), result)
     else:
-        # The SFTP connection will automatically start in the home directory
-        paths = ['', 'gtecs', '.gtecs']
-        # We will need to check the remote environment
-        # TODO: I'm not sure this works? Depends how the variable is set.
-        with Connection(remote_host, user=remote_user) as c:
-            result = c.run('echo $GTECS_CONF', hide='both').stdout.strip()
-            if result != '':
-                paths.append(result)
+        if key in _config_cache:
+            load_time, result = _config_cache[key]
+            if time.monotonic() - load_time < REMOTE_CONFIG_CACHE_TIME:
+                return copy.deepcopy(result)
+        result = _load_config(package, filenames, remote_host=remote_host, remote_user=remote_user)
+        _config_cache[key] = (time.monotonic(), result)
+    # Don't give out the cached objects, otherwise changes made by one caller would be seen by all
+    return copy.deepcopy(result)
 
-    # Load package configspec file
-    with pkg_resources.open_text(f'gtecs.{package}.data', 'configspec.ini') as spec_file:
-        spec = ConfigObj(spec_file, _inspec=True)
 
-    # Search all possible paths for the config file
-    config = None
-    config_filepath = None
-    for path in paths:
-        for file in filenames:
-            filepath = os.path.join(path, file)
-            if remote_host is None:
-                try:
-                    with open(filepath) as source:
-                        config = ConfigObj(source, configspec=spec)
-                        config_filepath = filepath
-                        break
-                except IOError:
-                    pass
-            else:
-                try:
-                    with Connection(remote_host, user=remote_user) as c, c.sftp() as sftp:
-                        with sftp.open(filepath) as source:
-                            config = ConfigObj(source, configspec=spec)
-                            config_filepath = filepath
-                            break
-                except FileNotFoundError:
-                    pass
-
-    # We didn't find a file, so just create an empty config to get default parameters
-    if config is None:
-        config = ConfigObj({}, configspec=spec)
+def clear_config_cache():
+    """Clear the cache of loaded configs, so the next call to `load_config` reloads the file."""
+    _config_cache.clear()
+    _default_config_cache.clear()
+    _remote_env_cache.clear()
 
-    # Validate ConfigObj, filling defaults from configspec if missing from config file
+
+def _validate_config(config, filenames):
+    """Validate a ConfigObj, filling defaults from the configspec if missing from the config."""
     validator = validate.Validator()
     result = config.validate(validator)
     if result is not True:
         print('Config file validation failed')
         print([k for k in result if not result[k]])
-        raise ValueError(f'{config_file} config file validation failed')
+        raise ValueError(f'{", ".join(filenames)} config file validation failed')
+
+
+# Cache of configs with only default parameters, for when no config file is found
+_default_config_cache = {}
+
+# Cache of the top-level keys in each package's configspec
+_spec_keys_cache = {}
+
+
+def _load_config(package, filenames, config_filepath=None, remote_host=None, remote_user=None):
+    """Load and validate package configuration file (see `load_config`)."""
+    # Load package configspec file
+    spec = _load_spec(package)
+
+    config = None
+    if remote_host is None:
+        if config_filepath is not None:
+            with open(config_filepath) as source:
+                config = ConfigObj(source, configspec=spec)
+    else:
+        # Use a single connection for everything, rather than a new SSH handshake for each file,
+        # and keep it open in case we want to load from the same host again.
+        # Each call gets its own SFTP channel though, so concurrent calls don't block each other.
+        c = get_connection(remote_host, remote_user)
+        c.open()
+        with c.client.open_sftp() as sftp:
+            config_filepath = _find_remote_config(filenames, c, sftp)
+            if config_filepath is not None:
+                with sftp.open(config_filepath) as source:
+                    config = ConfigObj(source, configspec=spec)
+
+    # We didn't find a file, so just use the default parameters from the configspec
+    # These will be the same every time, so only create and validate the config once
+    if config is None:
+        if package not in _default_config_cache:
+            default_config = ConfigObj({}, configspec=spec)
+            _validate_config(default_config, filenames)
+            _default_config_cache[package] = default_config
+        return _default_config_cache[package], spec, None
+
+    # Validate ConfigObj, filling defaults from configspec if missing from config file
+    _validate_config(config, filenames)
 
     # Also report any keys in the config that are not in the spec
     # This is useful for catching typos or any deprecated parameters
+    if package not in _spec_keys_cache:
+        _spec_keys_cache[package] = frozenset(spec.keys())
+    spec_keys = _spec_keys_cache[package]
     for key in config.keys():
-        if key not in spec:
+        if key not in spec_keys:
             print(f'Warning: {key} in {config_filepath.split("/")[-1]} is not in the configspec')
 
     return config, spec, config_filepath
 
 
+@functools.lru_cache(maxsize=None)
 def get_package_version(package):
-    """Load and validate package configuration file.
+    """Get the installed version of the given gtecs package.
+
+    The result is cached, since the installed version won't change while the process is running.
 
     Parameters
     ----------
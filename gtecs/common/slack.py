@@ -1,16 +1,109 @@
 """Slack messaging functions."""
 
+import atexit
 import json
 import os
+import queue
+import threading
 import time
+import weakref
+from collections import deque
 
-from slack_sdk import WebClient
+
+# Slack clients for each token (and timeout), so they are only created once
+# rather than for every message
+_client_cache = {}
+_client_lock = threading.Lock()
+
+
+def _get_client(token, timeout=60):
+    """Get the Slack client for the given token, creating it if needed."""
+    # The Slack SDK is slow to import, so only do it when actually needed
+    from slack_sdk import WebClient
+    from slack_sdk.http_retry import (BackoffRetryIntervalCalculator,
+                                      ConnectionErrorRetryHandler,
+                                      RateLimitErrorRetryHandler)
+
+    with _client_lock:
+        key = (token, timeout)
+        if key not in _client_cache:
+            retry_handlers = [
+                # Retry a few times on connection errors, rather than just once (the default)
+                ConnectionErrorRetryHandler(
+                    max_retry_count=3,
+                    interval_calculator=BackoffRetryIntervalCalculator(backoff_factor=0.3),
+                ),
+                # Wait and retry if we're rate limited (this respects the Retry-After header)
+                RateLimitErrorRetryHandler(max_retry_count=3),
+            ]
+            _client_cache[key] = WebClient(token=token, timeout=timeout,
+                                           retry_handlers=retry_handlers)
+        return _client_cache[key]
+
+
+# Workspace URLs for each token, used to build message permalinks
+_workspace_cache = {}
+
+
+def _get_workspace_url(client, token):
+    """Get the URL of the Slack workspace for the given token (e.g. https://myteam.slack.com/)."""
+    if token not in _workspace_cache:
+        response = client.auth_test()
+        _workspace_cache[token] = response['url']
+    return _workspace_cache[token]
+
+
+# Permalinks we've already looked up, keyed by (channel, message_ts)
+_permalink_cache = {}
+
+# How long (in seconds) to keep permalinks in the cache
+PERMALINK_CACHE_TIME = 600
+
+
+def _get_permalink(client, channel, message_ts):
+    """Get the permalink for the given message from Slack, or from the cache if we have it."""
+    key = (channel, message_ts)
+    if key in _permalink_cache:
+        cache_time, permalink = _permalink_cache[key]
+        if time.monotonic() - cache_time < PERMALINK_CACHE_TIME:
+            return permalink
+
+    response = client.chat_getPermalink(
+        channel=channel,
+        message_ts=message_ts,
+    )
+    if not response.get('ok'):
+        if 'error' in response:
+            raise Exception('Unable to retrieve permalink: {}'.format(response['error']))
+        else:
+            raise Exception('Unable to retrieve permalink')
+
+    permalink = response['permalink']
+    now = time.monotonic()
+    if len(_permalink_cache) > 100:
+        # Remove any expired entries, so the cache doesn't grow forever
+        for old_key, (cache_time, _) in list(_permalink_cache.items()):
+            if now - cache_time > PERMALINK_CACHE_TIME:
+                del _permalink_cache[old_key]
+    _permalink_cache[key] = (now, permalink)
+    return permalink
+
+
+def _get_retry_after(err):
+    """Get the Retry-After header from a failed Slack API call, or None if it wasn't given."""
+    # SlackApiErrors include the response, which we can check without importing slack_sdk
+    headers = getattr(getattr(err, 'response', None), 'headers', None) or {}
+    for key, value in headers.items():
+        if key.lower() == 'retry-after':
+            return value[0] if isinstance(value, list) else value
+    return None
 
 
 def send_message(text, channel, token,
                  attachments=None, blocks=None, filepath=None,
                  username=None, icon_emoji=None,
-                 return_link=False,
+                 return_link=False, local_link=True, timeout=60,
+                 attachments_json=None, blocks_json=None,
                  **kwargs):
     """Send a message to Slack.
 
@@ -49,12 +142,36 @@ def send_message(text, channel, token,
     return_link : bool, optional (default=False)
         If True, return a permalink URL to the posted message.
 
+    local_link : bool, optional (default=True)
+        If True (and `return_link` is True), build the permalink from the workspace URL
+        rather than asking Slack for it, which saves an API call for every message.
+        If False, or if the message is a thread reply, use chat.getPermalink instead.
+
+    timeout : int, optional (default=60)
+        The timeout in seconds for requests to Slack.
+        Uploading large files can take a while, so this is longer than the default of 30.
+
+    attachments_json : string, optional
+        Pre-serialised JSON attachments, used instead of `attachments`.
+        This is useful when sending the same attachments repeatedly, but note they are sent
+        as given (so 'mrkdwn_in' won't be added automatically).
+
+    blocks_json : string, optional
+        Pre-serialised JSON blocks, used instead of `blocks`.
+        This is useful when sending the same blocks repeatedly, but note the message text
+        won't be added as the first block (it will only be used for notifications).
+
     Any other keyword arguments are passed to the message payload,
     see https://api.slack.com/methods/chat.postMessage
     or https://api.slack.com/methods/files.upload for details.
 
     """
-    if (attachments is not None or blocks is not None) and filepath is not None:
+    if attachments is not None and attachments_json is not None:
+        raise ValueError("Can't give both attachments and attachments_json.")
+    if blocks is not None and blocks_json is not None:
+        raise ValueError("Can't give both blocks and blocks_json.")
+    has_extras = any(x is not None for x in (attachments, blocks, attachments_json, blocks_json))
+    if has_extras and filepath is not None:
         raise ValueError("A Slack message can't upload a file and include attachments/blocks.")
     if (username is not None or icon_emoji is not None) and filepath is not None:
         # I REALLY tried to get around this, but Slack just doesn't allow it.
@@ -72,36 +189,41 @@ def send_message(text, channel, token,
         # attempts to work around it all of which fail. Grrr.
         raise ValueError("A Slack message can't upload a file and include a custom username/icon.")
 
-    # Slack doesn't format attachments with markdown automatically
+    # Slack doesn't format attachments with markdown automatically.
+    # Note we make new lists here rather than modifying the ones we were given, otherwise
+    # callers that reuse the same attachments/blocks for every message would see them change.
     if attachments:
-        for attachment in attachments:
-            if 'mrkdwn_in' not in attachment:
-                attachment['mrkdwn_in'] = ['text']
+        attachments = [{'mrkdwn_in': ['text'], **attachment} for attachment in attachments]
+        attachments_json = json.dumps(attachments)
 
     # If blocks are included you can't give text, you have to add it as the first block.
     if blocks and text:
-        blocks.insert(0, {'type': 'section', 'text': {'type': 'mrkdwn', 'text': text}})
+        blocks = [{'type': 'section', 'text': {'type': 'mrkdwn', 'text': text}}, *blocks]
         text = None
+    if blocks:
+        blocks_json = json.dumps(blocks)
 
     try:
-        client = WebClient(token=token)
+        client = _get_client(token, timeout)
         if not filepath:
             response = client.chat_postMessage(
                 channel=channel,
-                text=str(text),
-                attachments=json.dumps(attachments) if attachments else None,
-                blocks=json.dumps(blocks) if blocks else None,
+                text=str(text) if text else None,
+                attachments=attachments_json or None,
+                blocks=blocks_json or None,
                 username=username,
                 icon_emoji=icon_emoji,
                 **kwargs,
             )
         else:
+            filename = os.path.basename(filepath)
+            if text:
+                kwargs['initial_comment'] = str(text)
             response = client.files_upload_v2(
                 channel=channel,
-                initial_comment=str(text),
                 file=filepath,
-                filename=os.path.basename(filepath),
-                title=os.path.splitext(os.path.basename(filepath))[0],
+                filename=filename,
+                title=os.path.splitext(filename)[0],
                 **kwargs,
             )
         if not response.get('ok'):
@@ -112,9 +234,13 @@ def send_message(text, channel, token,
 
     except Exception as err:
         print('Connection to Slack failed! - {}'.format(err))
+        retry_after = _get_retry_after(err)
+        if retry_after is not None:
+            # The client will already have retried, so we're still being rate limited
+            print('Rate limited by Slack, retry after {}s'.format(retry_after))
         print('Message:', text)
-        print('Attachments:', attachments)
-        print('Blocks:', blocks)
+        print('Attachments:', attachments or attachments_json)
+        print('Blocks:', blocks or blocks_json)
         print('Filepath:', filepath)
         return
 
@@ -122,46 +248,227 @@ def send_message(text, channel, token,
         try:
             if not filepath:
                 message_ts = response['ts']
+                channel = response['channel']  # Make sure we use the ID, not the name
             else:
                 # We want to get the timestamp of the message, not the file
                 # Annoyingly, with v2 Slack now scans all files and won't return the
                 # sharing message immediately
                 # (see https://github.com/slackapi/python-slack-sdk/issues/1329)
                 # So we have to wait and check the file info until the message is available.
-                shares = None
-                if len(response['file']['shares']) != 0:
-                    shares = response['file']['shares']
-                else:
+                shares = response['file'].get('shares') or None
+                if not shares:
                     file_id = response['file']['id']
                     start_time = time.time()
-                    timeout = 30
-                    while not shares:
-                        if time.time() - start_time > timeout:
-                            raise TimeoutError('Timeout waiting for file to be shared')
+                    share_timeout = 30
+                    # Small files are usually ready quickly but large ones can take a while,
+                    # so back off the polling rather than using a fixed interval
+                    delays = [0.1, 0.2, 0.4, 0.8, 1.5] + [3] * 10
+                    for delay in delays:
+                        time.sleep(delay)
                         response = client.files_info(file=file_id)
-                        if len(response['file']['shares']) != 0:
-                            shares = response['file']['shares']
-                        time.sleep(0.5)
+                        shares = response['file'].get('shares') or None
+                        if shares or time.time() - start_time > share_timeout:
+                            break
+                    if not shares:
+                        raise TimeoutError('Timeout waiting for file to be shared')
 
                 share_type = list(shares.keys())[0]  # 'public' or 'private'
                 if channel not in shares[share_type]:
                     raise ValueError('File not shared in correct channel?')
                 message_ts = shares[share_type][channel][-1]['ts']  # Get the latest share ts
 
-            # Get permalink for the message identified by the timestamp
-            response = client.chat_getPermalink(
-                channel=channel,
-                message_ts=message_ts,
-            )
-            if not response.get('ok'):
-                if 'error' in response:
-                    raise Exception('Unable to retrieve permalink: {}'.format(response['error']))
-                else:
-                    raise Exception('Unable to send message')
+            if local_link and 'thread_ts' not in kwargs:
+                # Permalinks are just the workspace URL, channel ID and message timestamp,
+                # so we can build them ourselves (thread replies need extra parameters though)
+                workspace_url = _get_workspace_url(client, token).rstrip('/')
+                return f'{workspace_url}/archives/{channel}/p{message_ts.replace(".", "")}'
 
-            return response['permalink']
+            # Get permalink for the message identified by the timestamp
+            return _get_permalink(client, channel, message_ts)
 
         except Exception as err:
             print('Unable to retrieve permalink - {}'.format(err))
     else:
         return response
+
+
+# Queue of messages to be sent in the background, see `send_message_async`
+_message_queue = queue.Queue(maxsize=1000)
+_message_thread = None
+_message_thread_lock = threading.Lock()
+
+# How long (in seconds) to wait for more messages to combine into a single post
+COALESCE_TIME = 0.5
+
+
+def _can_coalesce(message):
+    """Check if a queued message is plain text, so it can be combined with others."""
+    args, kwargs, coalesce = message
+    return coalesce and bool(args[0]) and set(kwargs) <= {'username', 'icon_emoji'}
+
+
+def _coalesce_key(message):
+    """Get the parameters that must match for queued messages to be combined."""
+    args, kwargs, _ = message
+    return (args[1], args[2], kwargs.get('username'), kwargs.get('icon_emoji'))
+
+
+def _message_worker():
+    """Send queued messages, combining consecutive plain text messages to the same channel."""
+    while True:
+        batch = [_message_queue.get()]
+        # Wait a short time for any more messages to arrive
+        if _can_coalesce(batch[0]):
+            deadline = time.monotonic() + COALESCE_TIME
+            while time.monotonic() < deadline:
+                try:
+                    batch.append(_message_queue.get(timeout=deadline - time.monotonic()))
+                except (queue.Empty, ValueError):
+                    # ValueError is raised if the timeout has become negative
+                    break
+
+        # Group consecutive messages that can be combined, so the order is preserved
+        groups = []
+        for message in batch:
+            if (groups and _can_coalesce(message) and _can_coalesce(groups[-1][0]) and
+                    _coalesce_key(message) == _coalesce_key(groups[-1][0])):
+                groups[-1].append(message)
+            else:
+                groups.append([message])
+
+        for group in groups:
+            args, kwargs, _ = group[0]
+            if len(group) > 1:
+                text = '\n'.join(str(message[0][0]) for message in group)
+                args = (text, *args[1:])
+            try:
+                send_message(*args, **kwargs)
+            except Exception as err:
+                # send_message already catches errors from Slack, but we can't let this thread die
+                print('Failed to send queued Slack message - {}'.format(err))
+            finally:
+                for _ in group:
+                    _message_queue.task_done()
+
+
+def _start_message_thread():
+    """Start the background thread that sends queued messages, if it isn't already running."""
+    global _message_thread
+    with _message_thread_lock:
+        if _message_thread is None:
+            _message_thread = threading.Thread(target=_message_worker, daemon=True)
+            _message_thread.start()
+
+
+def send_message_async(text, channel, token, coalesce=True, **kwargs):
+    """Queue a message to be sent to Slack in the background, rather than waiting for it.
+
+    Plain text messages sent to the same channel within a short time of each other
+    (see `COALESCE_TIME`) will be combined into a single post, unless `coalesce` is False.
+
+    All arguments are passed to `send_message`, but note nothing is returned
+    (so `return_link` has no effect).
+    """
+    _start_message_thread()
+    _message_queue.put(((text, channel, token), kwargs, coalesce))
+
+
+@atexit.register
+def flush_slack(timeout=30):
+    """Wait until all queued messages have been sent (or until `timeout` seconds have passed)."""
+    start_time = time.monotonic()
+    while _message_queue.unfinished_tasks:
+        if timeout is not None and time.monotonic() - start_time > timeout:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+# Batchers that might still have messages waiting, so they can be flushed at exit
+# (this doesn't keep them alive if they're never closed)
+_batchers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_batchers():
+    """Queue any messages still waiting in open batchers.
+
+    This is registered after `flush_slack`, so it runs first and they still get sent.
+    """
+    for batcher in list(_batchers):
+        batcher.flush()
+
+
+class SlackBatcher:
+    """Collect short messages and send them to a Slack channel as a single post.
+
+    Messages are sent when `flush()` is called, once `flush_time` seconds have passed since the
+    first one was added, or when adding another would take the post over `max_chars`.
+    Any remaining messages are sent when the batcher is closed (or used as a context manager),
+    or when the process exits.
+
+    Posts are sent in the background by `send_message_async`, so adding messages never waits
+    for Slack. Any other keyword arguments are passed to `send_message`.
+    """
+
+    def __init__(self, channel, token, flush_time=0.5, max_chars=3500, **kwargs):
+        self.channel = channel
+        self.token = token
+        self.flush_time = flush_time
+        self.max_chars = max_chars
+        self.kwargs = kwargs
+
+        self._messages = deque()
+        self._length = 0
+        self._lock = threading.Lock()
+        self._timer = None
+        _batchers.add(self)
+        # Start the sending thread now, since new threads can't be started while the
+        # interpreter is shutting down (which is when `_flush_batchers` might need it)
+        _start_message_thread()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, text):
+        """Add a message to be sent with the next batch."""
+        text = str(text)
+        with self._lock:
+            if self._messages and self._length + len(text) + 1 > self.max_chars:
+                self._flush()
+            self._messages.append(text)
+            self._length += len(text) + 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_time, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self):
+        """Queue any waiting messages to be sent (the lock must already be held).
+
+        This only puts them on the background queue, so the lock is never held while waiting
+        for Slack, but posts are still sent in order. They aren't combined with any other
+        queued messages, since that could take them over `max_chars`.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._messages:
+            return
+        text = '\n'.join(self._messages)
+        self._messages.clear()
+        self._length = 0
+        send_message_async(text, self.channel, self.token, coalesce=False, **self.kwargs)
+
+    def flush(self):
+        """Send any waiting messages now."""
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """Send any waiting messages, and stop tracking them to flush at exit."""
+        self.flush()
+        _batchers.discard(self)
@@ -0,0 +1,33 @@
+"""Functions for connecting to remote hosts."""
+
+import atexit
+import threading
+
+
+# Pool of SSH connections to remote hosts, keyed by (host, user)
+_connection_pool = {}
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection(host, user=None):
+    """Get an SSH connection to the given host, reusing an existing one if possible.
+
+    Connections are kept open until `close_connections` is called (or the process exits).
+    """
+    # Fabric (and paramiko etc) are slow to import, so only do it when actually needed
+    from fabric.connection import Connection
+
+    with _connection_pool_lock:
+        key = (host, user)
+        if key not in _connection_pool:
+            _connection_pool[key] = Connection(host, user=user)
+        return _connection_pool[key]
+
+
+@atexit.register
+def close_connections():
+    """Close all open SSH connections in the pool."""
+    with _connection_pool_lock:
+        for connection in _connection_pool.values():
+            connection.close()
+        _connection_pool.clear()
@@ -1,6 +1,9 @@
 """Functions for dealing with system processes."""
 
 import abc
+import functools
+import logging
+import shlex
 import signal
 import socket
 import subprocess
@@ -10,13 +13,37 @@ from contextlib import contextmanager
 import pid
 
 from . import config
+from .ssh import get_connection
 
 
+# Output from commands is logged rather than printed, so it can be silenced or redirected
+# by the application's logging configuration
+log = logging.getLogger(__name__)
+
+
+def _log(level, msg, *args):
+    """Log a message, or just print it if logging hasn't been set up.
+
+    This way the output is the same as it always was for scripts that don't use logging
+    (it still ends up in the log if `sys.stdout` is redirected by `get_logger`).
+    """
+    if log.hasHandlers():
+        log.log(level, msg, *args, stacklevel=2)
+    else:
+        print(msg % args)
+
+
+@functools.lru_cache(maxsize=1)
 def get_local_ip():
     """Get local IP address.
 
     https://stackoverflow.com/a/28950776
+
+    The result is cached, since it's checked every time we run a command on a host.
+    Use `get_local_ip.cache_clear()` if the address might have changed.
     """
+    # Connecting a UDP socket doesn't send anything, it just asks the kernel which address
+    # it would route from (unlike resolving our hostname, which can block on DNS)
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.settimeout(0)
     try:
@@ -30,19 +57,78 @@ def get_local_ip():
     return ip_addr
 
 
-def execute_command(command_string, timeout=30):
-    """Execute a command that should return quickly."""
-    print('{}:'.format(command_string))
+def run_command(command_string, host='127.0.0.1', verbose=False, split_output=False):
+    """Run a command on the given host and return the output (including stderr).
+
+    Commands on remote hosts are run over SSH, using a pooled connection from `get_connection`.
+
+    If `split_output` is True then stdout and stderr are returned separately, as a tuple.
+    """
+    if host in ['127.0.0.1', get_local_ip()]:
+        if verbose:
+            _log(logging.INFO, '%s', command_string)
+        if split_output:
+            p = subprocess.run(command_string, shell=True, capture_output=True, text=True)
+            return p.stdout.strip(), p.stderr.strip()
+        return subprocess.getoutput(command_string)
+
+    if verbose:
+        _log(logging.INFO, "ssh %s '%s'", host, command_string)
     try:
-        p = subprocess.Popen(command_string,
-                             shell=True,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-        ret_str, _ = p.communicate(timeout=timeout)
-        print('> ' + ret_str.strip().decode().replace('\n', '\n> '))
+        result = get_connection(host).run(command_string, hide=True, warn=True)
+    except OSError as err:
+        raise ConnectionError('Cannot connect to host {}'.format(host)) from err
+    if split_output:
+        return result.stdout.strip(), result.stderr.strip()
+    return (result.stdout + result.stderr).strip()
+
+
+# Characters that mean a command needs to be run through the shell
+_SHELL_CHARACTERS = set('|&;<>()$`\\*?[]{}~!#=\n')
+
+
+def execute_command(command_string, timeout=30, shell=None):
+    """Execute a command that should return quickly.
+
+    If `shell` is None then the command is only run through the shell if it looks like it
+    needs it (e.g. it uses pipes, redirects or variables), otherwise it is run directly
+    which saves starting an extra process. If running it directly fails (e.g. it's a shell
+    builtin like `cd` or `source`) then it is run through the shell instead.
+    """
+    _log(logging.INFO, '%s:', command_string)
+    auto_shell = shell is None
+    if auto_shell:
+        shell = any(char in _SHELL_CHARACTERS for char in command_string)
+    args = command_string
+    if not shell:
+        try:
+            args = shlex.split(command_string)
+        except ValueError:
+            # e.g. unbalanced quotes, so just let the shell deal with it
+            shell = True
+    try:
+        try:
+            p = subprocess.run(args,
+                               shell=shell,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               timeout=timeout)
+        except OSError:
+            if shell or not auto_shell:
+                raise
+            # Let the shell try instead (and report any errors like it used to)
+            p = subprocess.run(command_string,
+                               shell=True,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               timeout=timeout)
+        _log(logging.INFO, '> %s', p.stdout.strip().decode().replace('\n', '\n> '))
         return 0
+    except OSError as err:
+        _log(logging.INFO, '> %s', err)
+        return 1
     except subprocess.TimeoutExpired:
-        print('Command {} timed out after {}s'.format(command_string, timeout))
+        _log(logging.WARNING, 'Command %s timed out after %ss', command_string, timeout)
         return 1
 
 
@@ -53,12 +139,12 @@ def execute_long_command(command_string):
     or obs_scripts.
 
     """
-    print(command_string)
+    _log(logging.INFO, '%s', command_string)
     p = subprocess.Popen(command_string, shell=True, close_fds=True)
     try:
         p.wait()
     except KeyboardInterrupt:
-        print('...ctrl+c detected - closing ({})...'.format(command_string))
+        _log(logging.INFO, '...ctrl+c detected - closing (%s)...', command_string)
         try:
             p.terminate()
         except OSError:
@@ -68,21 +154,20 @@ def execute_long_command(command_string):
 
 def kill_process(pid_name, host='127.0.0.1', verbose=False):
     """Kill any specified processes."""
-    pid = get_pid(pid_name, host)
-
-    command_string = 'kill -9 {}'.format(pid)
-    if host not in ['127.0.0.1', get_local_ip()]:
-        command_string = "ssh {} '{}'".format(host, command_string)  # TODO: use fabric?
-
-    if verbose:
-        print(command_string)
-    output = subprocess.getoutput(command_string)
-    if 'No route to host' in output:
-        raise ConnectionError('Cannot connect to host {}'.format(host))
+    pid_file = pid_name + '.pid'
+    pid_path = get_pid_path() / pid_file
 
-    clear_pid(pid_name, host)
+    # Read the pid, kill the process and clear the pid file all in one go,
+    # rather than needing a separate round-trip to the host for each step
+    # (this is the same as calling get_pid, kill and then clear_pid)
+    command_string = 'pid=$(cat {0}) && kill -9 $pid; rm -f {0}; echo $pid'.format(pid_path)
+    # Only check stdout for the pid, since any errors (e.g. from killing a stale pid)
+    # might come after it
+    output, _ = run_command(command_string, host, verbose, split_output=True)
+    lines = output.splitlines()
+    pid = int(lines[-1]) if lines and lines[-1].isdigit() else None
 
-    print('Killed process {} on {}'.format(pid, host))
+    _log(logging.INFO, 'Killed process %s on %s', pid, host)
 
 
 class MultipleProcessError(Exception):
@@ -118,18 +203,11 @@ def get_pid(pid_name, host='127.0.0.1', verbose=False):
     pid_file = pid_name + '.pid'
     pid_path = get_pid_path() / pid_file
 
+    # NOTE this assumes the pid path is the same on the remote machine,
+    # which should be now we've standardised on the ~/.config directory.
+    # Unless they changed XDG_CONFIG_HOME for some reason...
     command_string = 'cat {}'.format(pid_path)
-    if host not in ['127.0.0.1', get_local_ip()]:
-        # NOTE this assumes the pid path is the same on the remote machine,
-        # which should be now we've standardised on the ~/.config directory.
-        # Unless they changed XDG_CONFIG_HOME for some reason...
-        command_string = "ssh {} '{}'".format(host, command_string)  # TODO: use fabric?
-
-    if verbose:
-        print(command_string)
-    output = subprocess.getoutput(command_string)
-    if 'No route to host' in output:
-        raise ConnectionError('Cannot connect to host {}'.format(host))
+    output = run_command(command_string, host, verbose)
 
     if 'No such file or directory' in output:
         return None
@@ -142,23 +220,16 @@ def clear_pid(pid_name, host='127.0.0.1', verbose=False):
     pid_file = pid_name + '.pid'
     pid_path = get_pid_path() / pid_file
 
+    # NOTE: This assumes the pid path is the same on the remote machine,
+    # which should be now we've standardised on the ~/.config directory.
+    # Unless they changed XDG_CONFIG_HOME for some reason...
     command_string = 'rm {}'.format(pid_path)
-    if host not in ['127.0.0.1', get_local_ip()]:
-        # NOTE: This assumes the pid path is the same on the remote machine,
-        # which should be now we've standardised on the ~/.config directory.
-        # Unless they changed XDG_CONFIG_HOME for some reason...
-        command_string = "ssh {} '{}'".format(host, command_string)  # TODO: use fabric?
-
-    if verbose:
-        print(command_string)
-    output = subprocess.getoutput(command_string)
-    if 'No route to host' in output:
-        raise ConnectionError('Cannot connect to host {}'.format(host))
+    output = run_command(command_string, host, verbose)
 
     if not output or 'No such file or directory' in output:
         return 0
     else:
-        print(output)
+        _log(logging.WARNING, '%s', output)
         return 1
 
 
@@ -178,12 +249,20 @@ class NeatCloser(metaclass=abc.ABCMeta):
 
     def __init__(self, task_name):
         self.task_name = task_name
+        self._shutting_down = False
         # redirect SIGTERM, SIGINT to us
         signal.signal(signal.SIGTERM, self.interrupt)
         signal.signal(signal.SIGINT, self.interrupt)
 
     def interrupt(self, sig, handler):
         """Catch interrupts."""
+        # If we get another signal while tidying up then don't start again
+        if self._shutting_down:
+            return
+        self._shutting_down = True
+        # Restore the default handler, so a repeated signal will still kill the process
+        # if the tidy up gets stuck
+        signal.signal(sig, signal.SIG_DFL)
         print('{} received kill signal'.format(self.task_name))
         # do things here on interrupt
         self.tidy_up()